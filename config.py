@@ -66,12 +66,14 @@ JIRA_PRIORITY_MAJOR = os.getenv("JIRA_PRIORITY_MAJOR", "").strip()
 JIRA_PRIORITY_MINOR = os.getenv("JIRA_PRIORITY_MINOR", "").strip()
 
 # Видимость действий
-BROWSER_SLOW_MO = int(os.getenv("BROWSER_SLOW_MO", "300"))
 HIGHLIGHT_DURATION_MS = int(os.getenv("HIGHLIGHT_DURATION_MS", "800"))
 # В CI (GITHUB_ACTIONS, GITLAB_CI, CI=1) по умолчанию headless, если не задан HEADLESS вручную
 _headless_env = os.getenv("HEADLESS", "").lower()
 _ci_env = bool(os.getenv("CI") or os.getenv("GITHUB_ACTIONS") or os.getenv("GITLAB_CI"))
 HEADLESS = _headless_env in ("1", "true", "yes") or (_ci_env and _headless_env != "false" and _headless_env != "0")
+# Замедление каждой операции Playwright — только чтобы человек успевал следить.
+# В headless смотреть некому: по умолчанию 0, явный BROWSER_SLOW_MO по-прежнему уважается.
+BROWSER_SLOW_MO = int(os.getenv("BROWSER_SLOW_MO", "0" if HEADLESS else "300"))
 # Размер окна браузера (по умолчанию Full HD — на весь экран)
 VIEWPORT_WIDTH = int(os.getenv("VIEWPORT_WIDTH", "1920"))
 VIEWPORT_HEIGHT = int(os.getenv("VIEWPORT_HEIGHT", "1080"))
@@ -124,7 +126,7 @@ IGNORE_CONSOLE_PATTERNS = [
     "ads.",
     "adservice",
 ]
-IGNORE_NETWORK_STATUSES = {404}  # можно расширить: 502, 503 для тестовой среды
+IGNORE_NETWORK_STATUSES = frozenset({404})  # можно расширить: 502, 503 для тестовой среды
 
 # Отдельные паттерны игнора сетевых запросов (URL). Не путать с IGNORE_CONSOLE_PATTERNS.
 IGNORE_NETWORK_URL_PATTERNS = [
@@ -154,12 +154,12 @@ from src.page_analyzer import (
     detect_page_type,
     detect_form_fields,
     detect_table_structure,
+    install_dom_helpers,
 )
 from src.visible_actions import (
     inject_cursor,
     move_cursor_to,
     highlight_and_click,
-    safe_highlight,
     scroll_to_center,
     inject_llm_overlay,
     update_llm_overlay,
@@ -196,39 +196,13 @@ from src.agent_memory import AgentMemory  # noqa: E402,F401
 
 
 # --- Скриншот в base64 ---
-def _hide_agent_ui(page: Page):
-    """Скрыть UI агента перед скриншотом (Shadow DOM host)."""
-    try:
-        page.evaluate("""() => {
-            if (window.__agentShadow && window.__agentShadow.host) {
-                window.__agentShadow.host.style.display = 'none';
-            }
-            // Временные элементы (label, ripple)
-            document.querySelectorAll('[data-agent-host]').forEach(el => el.style.display = 'none');
-        }""")
-    except Exception:
-        pass
-
-
-def _show_agent_ui(page: Page):
-    """Вернуть UI агента после скриншота."""
-    try:
-        page.evaluate("""() => {
-            if (window.__agentShadow && window.__agentShadow.host) {
-                window.__agentShadow.host.style.display = '';
-            }
-            document.querySelectorAll('[data-agent-host]').forEach(el => el.style.display = '');
-        }""")
-    except Exception:
-        pass
-
-
+# UI агента в странице больше нет (визуальный слой убран, см. visible_actions) —
+# прятать перед скриншотом нечего, лишние evaluate с querySelectorAll не делаем.
 def take_screenshot_b64(page: Page) -> Optional[str]:
-    """Сделать скриншот (без UI агента) и вернуть base64-строку."""
+    """Сделать скриншот и вернуть base64-строку."""
     try:
         if page.is_closed():
             return None
-        _hide_agent_ui(page)
         raw = page.screenshot(type="png")
         return base64.b64encode(raw).decode("ascii")
     except Exception as e:
@@ -236,12 +210,6 @@ def take_screenshot_b64(page: Page) -> Optional[str]:
             return None
         print(f"[Agent] Ошибка скриншота: {e}")
         return None
-    finally:
-        try:
-            if not page.is_closed():
-                _show_agent_ui(page)
-        except Exception:
-            pass
 
 
 def describe_element_for_report(page: Page, selector: str) -> str:
@@ -544,7 +512,6 @@ def _do_click(page: Page, selector: str, reason: str = "") -> str:
                 pass
             
             print(f"[Agent] КЛИК: {selector[:50]} ({reason[:30]})")
-            scroll_to_center(loc, page)
             loc.click()
             print(f"[Agent] Клик выполнен: {selector[:50]}")
             return f"clicked: {selector[:50]}"
@@ -654,7 +621,6 @@ def _do_type(page: Page, selector: str, value: str, form_strategy: str = "happy"
     if loc:
         try:
             print(f"[Agent] ВВОД: {selector[:50]} = {value[:30]}")
-            scroll_to_center(loc, page)
             loc.click()
             loc.fill(value)
             # Верификация: значение действительно попало в поле
@@ -716,7 +682,6 @@ def _do_scroll(page: Page, direction: str) -> str:
             loc = _find_element(page, direction)
             if loc:
                 loc.scroll_into_view_if_needed()
-                safe_highlight(loc, page, 0.3)
                 return f"scrolled_to: {direction[:30]}"
             page.evaluate(f"window.scrollBy(0, {SCROLL_PIXELS})")
             return "scrolled_down"
@@ -730,7 +695,6 @@ def _do_hover(page: Page, selector: str) -> str:
     loc = _find_element(page, selector)
     if loc:
         try:
-            safe_highlight(loc, page, 0.3)
             loc.hover()
             time.sleep(1.0)  # Ждём появления тултипа/дропдауна после ховера
             return f"hovered: {selector[:50]}"
@@ -752,7 +716,6 @@ def _do_close_modal(page: Page, selector: str = "") -> str:
         loc = _find_element(page, selector)
         if loc:
             try:
-                safe_highlight(loc, page, 0.3)
                 highlight_and_click(loc, page, description="Закрываю")
                 time.sleep(0.5)
                 return f"modal_closed_by_selector: {selector[:40]}"
@@ -784,7 +747,6 @@ def _do_close_modal(page: Page, selector: str = "") -> str:
         try:
             loc = page.locator(cs).first
             if loc.count() > 0 and loc.is_visible():
-                safe_highlight(loc, page, 0.3)
                 highlight_and_click(loc, page, description="Закрываю")
                 time.sleep(0.5)
                 return f"modal_closed_by_standard: {cs[:40]}"
@@ -840,7 +802,6 @@ def _do_select_option(page: Page, selector: str, value: str) -> str:
             try:
                 opt = page.locator(os_sel).first
                 if opt.count() > 0 and opt.is_visible():
-                    safe_highlight(opt, page, 0.3)
                     highlight_and_click(opt, page, description=f"Выбираю: {value[:20]}")
                     time.sleep(0.5)
                     return f"selected_custom: {value[:30]}"
@@ -929,7 +890,6 @@ def try_accept_cookie_banner(page: Page) -> bool:
             return False
         loc = _find_element(page, text)
         if loc:
-            safe_highlight(loc, page, 0.3)
             highlight_and_click(loc, page, description="Принять")
             time.sleep(1.0)
             print(f"[Agent] Закрыт баннер: {text[:50]}")
@@ -1317,6 +1277,9 @@ def run_agent(start_url: str = None):
             localStorage.setItem('onboarding_is_passed', 'true');
             localStorage.setItem('hrp-core-app/app-mode', '"neuro"');
         """)
+        # Хелперы get_dom_summary — один раз на каждый документ, а не на каждый evaluate;
+        # на уровне контекста, чтобы их получали и новые вкладки
+        install_dom_helpers(context)
 
         # --- Обработка новых вкладок (target="_blank" и т.п.) ---
         new_tabs_queue: List[Any] = []   # очередь вкладок для обработки
@@ -3106,14 +3069,7 @@ def _get_fast_action(
             const scopeEl = scopeSel ? document.querySelector(scopeSel) : null;
             if (scopeSel && !scopeEl) return [];
             const result = [];
-            const isAgent = (el) => {
-                let c = el;
-                while (c && c !== document.body) {
-                    if (c.hasAttribute && c.hasAttribute('data-agent-host')) return true;
-                    c = c.parentElement;
-                }
-                return false;
-            };
+            const isAgent = (el) => !!el.closest('[data-agent-host]');
             const inViewport = (el) => {
                 const r = el.getBoundingClientRect();
                 const vw = window.innerWidth, vh = window.innerHeight;
@@ -3177,7 +3133,10 @@ def _get_fast_action(
                 """ + ("if (scopeEl && !scopeEl.contains(el)) return;" if scope_sel else "") + """
                 let ref = el.getAttribute('data-agent-ref');
                 if (!ref) return;
-                const opts = Array.from(el.options).slice(0,3).map(o => o.text.trim()).join(',');
+                const optTexts = [];
+                const n = Math.min(3, el.options.length);
+                for (let i = 0; i < n; i++) optTexts.push(el.options[i].text.trim());
+                const opts = optTexts.join(',');
                 result.push({ref: 'ref:' + ref, type: 'select', text: opts, priority: 2});
             });
             document.querySelectorAll('[role="tab"]').forEach(el => {
@@ -3219,14 +3178,7 @@ def _get_fast_action(
         if scope_selector and not elements:
             elements = page.evaluate("""() => {
             const result = [];
-            const isAgent = (el) => {
-                let c = el;
-                while (c && c !== document.body) {
-                    if (c.hasAttribute && c.hasAttribute('data-agent-host')) return true;
-                    c = c.parentElement;
-                }
-                return false;
-            };
+            const isAgent = (el) => !!el.closest('[data-agent-host]');
             const inViewport = (el) => {
                 const r = el.getBoundingClientRect();
                 const vw = window.innerWidth, vh = window.innerHeight;
@@ -3288,7 +3240,10 @@ def _get_fast_action(
                 if (!vis(el) || isAgent(el)) return;
                 let ref = el.getAttribute('data-agent-ref');
                 if (!ref) return;
-                const opts = Array.from(el.options).slice(0,3).map(o => o.text.trim()).join(',');
+                const optTexts = [];
+                const n = Math.min(3, el.options.length);
+                for (let i = 0; i < n; i++) optTexts.push(el.options[i].text.trim());
+                const opts = optTexts.join(',');
                 result.push({ref: 'ref:' + ref, type: 'select', text: opts, priority: 2});
             });
             // Табы (приоритет 2)
@@ -239,10 +239,13 @@ def run_iframe_check(
         return
     try:
         iframes = page.evaluate("""() => {
-            return Array.from(document.querySelectorAll('iframe'))
-                .filter(f => f.src && !f.src.startsWith('about:') && f.width > 50 && f.height > 50)
-                .map(f => ({ src: f.src.slice(0, 200), name: f.name || '', id: f.id || '' }))
-                .slice(0, 3);
+            const out = [];
+            for (const f of document.querySelectorAll('iframe')) {
+                if (!f.src || f.src.startsWith('about:') || !(f.width > 50 && f.height > 50)) continue;
+                out.push({ src: f.src.slice(0, 200), name: f.name || '', id: f.id || '' });
+                if (out.length >= 3) break;
+            }
+            return out;
         }""")
         for iframe_info in (iframes or []):
             src = iframe_info.get("src", "")
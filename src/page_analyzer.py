@@ -2,9 +2,12 @@
 Сбор и анализ консоли, сети и DOM страницы для передачи агенту и в Jira.
 """
 import base64
-from typing import List, Dict, Any, Optional
+import json
+import re
+from itertools import islice
+from typing import List, Dict, Any, Optional, Union
 
-from playwright.sync_api import Page
+from playwright.sync_api import BrowserContext, Page
 
 from config import (
     IGNORE_CONSOLE_PATTERNS,
@@ -15,6 +18,277 @@ from config import (
 )
 
 
+def _js_regex_source(patterns) -> str:
+    """Склеить подстроки в source для JS RegExp: альтернация с экранированием спецсимволов."""
+    return "|".join(re.sub(r"[\\^$.*+?()[\]{}|]", r"\\\g<0>", p) for p in patterns if p)
+
+
+# Служебные виджеты (чат, поддержка, cookie, UI агента) — не часть тестируемого приложения.
+_DOM_SERVICE_PATTERNS = (
+    "chat", "чат", "support", "поддержк", "help", "консультант", "jivo", "intercom", "crisp",
+    "drift", "tawk", "livechat", "live-chat", "widget-chat", "chat-widget", "feedback", "обратн",
+    "звонок", "callback", "kventin", "agent-llm", "agent-banner", "диалог с llm", "ai-тестировщик",
+    "gigachat", "cookie", "consent",
+)
+# Source регулярок собираем один раз при импорте; в браузере RegExp строится один раз на вызов.
+_DOM_SERVICE_RE_SRC = _js_regex_source(_DOM_SERVICE_PATTERNS)
+_OVERLAY_IGNORE_RE_SRC = _js_regex_source(OVERLAY_IGNORE_PATTERNS or ())
+
+# Общий для page.evaluate-скриптов код реестра ref-ов (window.__agentRefs и т.п.).
+# __agentRefsCleanup освобождает ref-ы отсоединённых нод, а при переполнении —
+# самые старые (ключи-числа Object.keys отдаёт по возрастанию); возвращает
+# максимальный живой ref. Держит реестр ограниченным на долгих SPA-сессиях.
+_AGENT_REFS_JS = """
+    if (!window.__agentRefs) window.__agentRefs = {};
+    if (!window.__agentRefMeta) window.__agentRefMeta = {};   // ref -> stable_key
+    if (!window.__agentLocator) window.__agentLocator = {};   // ref -> canonical locator (Playwright-friendly)
+    if (!window.__agentRefsCleanup) {
+        window.__agentRefsCleanup = (cap = 2000) => {
+            const refs = window.__agentRefs;
+            const drop = (k) => { delete refs[k]; delete window.__agentRefMeta[k]; delete window.__agentLocator[k]; };
+            const live = [];
+            for (const k of Object.keys(refs)) {
+                const el = refs[k];
+                if (!el || !el.isConnected) drop(k);
+                else live.push(parseInt(k, 10));
+            }
+            if (live.length > cap) {
+                for (const n of live.splice(0, live.length - cap)) {
+                    try { refs[n].removeAttribute('data-agent-ref'); } catch (e) {}
+                    drop(n);
+                }
+            }
+            return live.length ? live[live.length - 1] : 0;
+        };
+    }
+"""
+
+
+# Хелперы get_dom_summary, живущие в window между вызовами: функции создаются один
+# раз на документ, и V8 сохраняет для них type feedback и оптимизированный код, а не
+# собирает его заново на каждом page.evaluate. Ставятся через add_init_script
+# (install_dom_helpers), для документов без него — лениво из get_dom_summary.
+_DOM_HELPERS_JS = """
+if (!window.__agentVis) {
+    // offsetParent === null означает display:none у самого элемента или предка —
+    // кроме position:fixed (у них offsetParent всегда null). visibility/opacity
+    // offsetParent не ловит: проверяем их после getBoundingClientRect, когда стиль
+    // и layout уже посчитаны. checkVisibility учитывает и opacity предков.
+    const hiddenByStyle = (el) => {
+        if (typeof el.checkVisibility === 'function') {
+            return !el.checkVisibility({ visibilityProperty: true, opacityProperty: true });
+        }
+        const s = getComputedStyle(el);
+        return s.visibility === 'hidden' || s.opacity === '0';
+    };
+    window.__agentVis = (el) => {
+        if (!el) return false;
+        const r = el.getBoundingClientRect();
+        if (r.width === 0 || r.height === 0) return false;
+        const vw = window.innerWidth, vh = window.innerHeight;
+        if (!(r.top < vh && r.bottom > 0 && r.left < vw && r.right > 0)) return false;
+        if (el.offsetParent === null && getComputedStyle(el).position !== 'fixed') return false;
+        return !hiddenByStyle(el);
+    };
+
+    // Описание элемента (компактная запись, с ref)
+    // Строку собирает Python (_format_dom_entry) — только для того, что влезет в лимит.
+    window.__agentDesc = (el, type, ref) => {
+        const tag = el.tagName.toLowerCase();
+        const d = { r: ref, t: type || tag };
+        const text = (el.textContent || el.value || el.placeholder || '').trim().replace(/\\s+/g, ' ').slice(0, 60);
+        if (text) d.tx = text;
+        if (el.id) d.id = String(el.id);
+        const aria = el.getAttribute('aria-label');
+        if (aria) d.al = aria.slice(0,40);
+        if (el.name) d.nm = String(el.name);
+        if (el.placeholder) d.ph = el.placeholder.slice(0,30);
+        if (el.disabled) d.dis = 1;
+        const href = el.getAttribute('href');
+        if (href) d.href = href.slice(0,60);
+        if (tag === 'select') {
+            const opts = [];
+            const n = Math.min(5, el.options.length);
+            for (let i = 0; i < n; i++) opts.push(el.options[i].text.trim().slice(0,20));
+            if (opts.length) d.opts = opts;
+        }
+        if (el.type === 'checkbox' || el.type === 'radio') d.chk = !!el.checked;
+        const role = el.getAttribute('role');
+        if (role) d.role = role;
+        return d;
+    };
+
+    // --- Стабильный ключ элемента (одинаковый между перерисовками DOM) ---
+    // Должен совпадать со stable_key_from_attrs в src/locators.py.
+    const norm = (s) => (s || '').toString().replace(/\\s+/g, ' ').trim().toLowerCase().slice(0, 60);
+    const escAttr = (s) => String(s).replace(/\\\\/g, '\\\\\\\\').replace(/"/g, '\\\\"');
+
+    // --- Канонический локатор (для записи в дефект Jira) ---
+    // Возвращает ЧИТАЕМЫЙ Playwright-совместимый селектор.
+    // Приоритет:
+    //   1) data-testid → getByTestId('...')
+    //   2) #id → #foo (стабильный id)
+    //   3) name=...[type=...] → input[name=...]
+    //   4) aria-label → getByLabel('...')
+    //   5) role + accessible name → getByRole('button',{name:'...'})
+    //   6) placeholder → getByPlaceholder('...')
+    //   7) видимый текст (короткий) → getByText('...')
+    //   8) CSS-fallback ТОЛЬКО из «осмысленных» классов; иначе — tag.
+    //
+    // Ключевая фишка: фильтруем «случайные» CSS-классы из CSS-in-JS
+    // (styled-components, emotion): sc-fEcDHC, jsx-1234567890, css-1abc23.
+    const RANDOM_CLASS_RE = /^(?:sc-[a-z0-9]+|jsx-[0-9]+|css-[a-z0-9]+|emotion-[0-9a-z]+|tw-[0-9a-z]+|[A-Z][a-zA-Z]*__[A-Za-z0-9-]+|.{2,}-[a-z0-9]{5,})$/;
+    const isMeaningfulClass = (c) => {
+        if (!c) return false;
+        if (c.length < 3 || c.length > 40) return false;
+        if (RANDOM_CLASS_RE.test(c)) return false;
+        if (/^[A-Z][a-zA-Z]*-[a-z]+$/.test(c)) return false;  // BEM-подобный с хвостом
+        if (/^_/.test(c)) return false;
+        return true;
+    };
+    const isStableId = (id) => {
+        if (!id) return false;
+        if (id.length > 64) return false;
+        if (/^[a-f0-9]{8,}$/i.test(id)) return false;          // hex-id
+        if (/[0-9]{6,}/.test(id)) return false;                // длинные числа
+        if (/^uid-|^_uid-|^id-[0-9]+|^.*--[a-z0-9]{6,}$/.test(id)) return false;
+        if (/:r[0-9a-z]+:/i.test(id)) return false;            // React useId
+        return true;
+    };
+    const accessibleName = (el) => {
+        const aria = (el.getAttribute && el.getAttribute('aria-label')) || '';
+        if (aria) return aria.replace(/\\s+/g, ' ').trim();
+        const labelledby = (el.getAttribute && el.getAttribute('aria-labelledby')) || '';
+        if (labelledby) {
+            try {
+                const ids = labelledby.split(/\\s+/);
+                const txt = ids.map(i => (document.getElementById(i) || {}).innerText || '').join(' ').trim();
+                if (txt) return txt.replace(/\\s+/g,' ').slice(0, 80);
+            } catch (e) {}
+        }
+        if (el.tagName === 'INPUT' && el.id) {
+            try {
+                const lbl = document.querySelector('label[for="' + escAttr(el.id) + '"]');
+                if (lbl && lbl.innerText) return lbl.innerText.replace(/\\s+/g,' ').trim().slice(0, 80);
+            } catch (e) {}
+        }
+        return '';
+    };
+    const implicitRole = (el) => {
+        const tag = el.tagName.toLowerCase();
+        const explicit = (el.getAttribute && el.getAttribute('role')) || '';
+        if (explicit) return explicit;
+        if (tag === 'button') return 'button';
+        if (tag === 'a' && el.getAttribute('href')) return 'link';
+        if (tag === 'input') {
+            const t = (el.type || 'text').toLowerCase();
+            if (t === 'checkbox') return 'checkbox';
+            if (t === 'radio') return 'radio';
+            if (t === 'submit' || t === 'button') return 'button';
+            if (t === 'search') return 'searchbox';
+            return 'textbox';
+        }
+        if (tag === 'textarea') return 'textbox';
+        if (tag === 'select') return 'combobox';
+        if (tag === 'img') return 'img';
+        if (tag === 'nav') return 'navigation';
+        if (/^h[1-6]$/.test(tag)) return 'heading';
+        return '';
+    };
+    const visibleText = (el) => {
+        const t = (el.innerText || el.textContent || '').replace(/\\s+/g, ' ').trim();
+        return t;
+    };
+    window.__agentCanonicalLocator = (el) => {
+        if (!el || !el.tagName) return '';
+        const tag = el.tagName.toLowerCase();
+        const tid = (el.getAttribute && (el.getAttribute('data-testid')
+            || el.getAttribute('data-test-id')
+            || el.getAttribute('data-test')
+            || el.getAttribute('data-qa'))) || '';
+        if (tid) return 'getByTestId(\\'' + escAttr(tid) + '\\')';
+        if (el.id && isStableId(el.id)) return '#' + el.id;
+        if (el.name) return tag + '[name="' + escAttr(el.name) + '"]';
+
+        const aname = accessibleName(el);
+        if (aname) return 'getByLabel(\\'' + escAttr(aname.slice(0, 80)) + '\\')';
+
+        const role = implicitRole(el);
+        const text = visibleText(el);
+        const shortText = text.length <= 60 ? text : '';
+        if (role && shortText) {
+            return "getByRole('" + role + "', { name: '" + escAttr(shortText) + "' })";
+        }
+        const ph = el.placeholder || '';
+        if (ph) return 'getByPlaceholder(\\'' + escAttr(ph.slice(0, 60)) + '\\')';
+        if (shortText && shortText.length >= 2) {
+            return 'getByText(\\'' + escAttr(shortText) + '\\')';
+        }
+
+        // CSS fallback: только осмысленные классы.
+        if (typeof el.className === 'string') {
+            const meaningful = el.className.trim().split(/\\s+/).filter(isMeaningfulClass);
+            if (meaningful.length) return tag + '.' + meaningful.slice(0, 2).join('.');
+        }
+        return tag;
+    };
+
+    window.__agentStableKey = (el) => {
+        if (!el || !el.tagName) return '';
+        const tag = el.tagName.toLowerCase();
+        const tid = (el.getAttribute && (el.getAttribute('data-testid')
+            || el.getAttribute('data-test-id')
+            || el.getAttribute('data-test')
+            || el.getAttribute('data-qa'))) || '';
+        if (tid) return 'tid:' + tid;
+        if (el.id) return 'id:' + el.id;
+        const name = el.name || '';
+        if (name) return 'name:' + tag + ':' + name;
+        const aria = (el.getAttribute && el.getAttribute('aria-label')) || '';
+        if (aria) return 'aria:' + tag + ':' + norm(aria);
+        const role = (el.getAttribute && el.getAttribute('role')) || '';
+        const text = norm(el.innerText || el.textContent || el.value || el.placeholder || '');
+        if (role && text) return 'role:' + role + ':' + text;
+        if (text) return 'text:' + tag + ':' + text;
+        const ph = el.placeholder || '';
+        if (ph) return 'ph:' + tag + ':' + norm(ph);
+        let cls = '';
+        if (typeof el.className === 'string') {
+            cls = el.className.trim().split(/\\s+/).filter(Boolean).slice(0, 2).join('.');
+        }
+        return cls ? ('css:' + tag + '.' + cls) : ('css:' + tag);
+    };
+}
+"""
+
+# То же тело как функция для page.evaluate в уже загруженном документе
+_DOM_HELPERS_EVAL_JS = "() => {" + _DOM_HELPERS_JS + "}"
+
+
+def install_dom_helpers(target: Union[Page, BrowserContext]) -> None:
+    """
+    Зарегистрировать хелперы DOM-описания для всех будущих документов и текущих.
+    target — страница или весь контекст (тогда и для вкладок, открытых позже).
+    Init-скрипт регистрируется один раз (флаг на стороне Python): повторные
+    add_init_script не заменяют, а копятся и выполнялись бы на каждой навигации.
+    """
+    pages = [target] if isinstance(target, Page) else list(target.pages)
+    try:
+        registered = getattr(target, "_agent_dom_helpers", False)
+        if isinstance(target, Page):
+            registered = registered or getattr(target.context, "_agent_dom_helpers", False)
+        if not registered:
+            target.add_init_script(_DOM_HELPERS_JS)
+            target._agent_dom_helpers = True
+    except Exception:
+        pass
+    for p in pages:
+        try:
+            p.evaluate(_DOM_HELPERS_EVAL_JS)
+        except Exception:
+            pass
+
+
 def take_screenshot_b64(page: Page) -> Optional[str]:
     """Сделать скриншот страницы и вернуть base64-строку."""
     try:
@@ -26,22 +300,26 @@ def take_screenshot_b64(page: Page) -> Optional[str]:
         return None
 
 
+def _compile_ignore_re(patterns) -> Optional[re.Pattern]:
+    """Одна регулярка-альтернация по подстрокам (без учёта регистра); None для пустого списка."""
+    patterns = [p for p in patterns if p]
+    if not patterns:
+        return None
+    return re.compile("|".join(re.escape(p) for p in patterns), re.IGNORECASE)
+
+
+_IGNORE_CONSOLE_RE = _compile_ignore_re(IGNORE_CONSOLE_PATTERNS)
+_IGNORE_NETWORK_URL_RE = _compile_ignore_re(IGNORE_NETWORK_URL_PATTERNS)
+
+
 def _should_ignore_console(text: str) -> bool:
-    text_lower = text.lower()
-    for pattern in IGNORE_CONSOLE_PATTERNS:
-        if pattern.lower() in text_lower:
-            return True
-    return False
+    return bool(_IGNORE_CONSOLE_RE and _IGNORE_CONSOLE_RE.search(text))
 
 
 def _should_ignore_network(url: str, status: Optional[int]) -> bool:
     if status in IGNORE_NETWORK_STATUSES:
         return True
-    url_lower = url.lower()
-    for pattern in IGNORE_NETWORK_URL_PATTERNS:
-        if pattern in url_lower:
-            return True
-    return False
+    return bool(_IGNORE_NETWORK_URL_RE and _IGNORE_NETWORK_URL_RE.search(url))
 
 
 def collect_console_messages(page: Page) -> List[Dict[str, Any]]:
@@ -163,16 +441,16 @@ def detect_table_structure(page: Page) -> List[Dict[str, Any]]:
                     if (text) headers.push(text.slice(0, 50));
                 });
                 
-                // Ищем фильтры рядом с таблицей
+                // Ищем фильтры рядом с таблицей: один обход от 3-го предка
+                // (его поддерево включает поддеревья всех промежуточных).
                 const filters = [];
-                let parent = table.parentElement;
-                for (let i = 0; i < 3 && parent; i++) {
-                    const filterInputs = parent.querySelectorAll('input[type="text"], input[type="search"], select, [role="combobox"]');
-                    filterInputs.forEach(inp => {
+                let top = table;
+                for (let i = 0; i < 3 && top.parentElement; i++) top = top.parentElement;
+                if (top !== table) {
+                    top.querySelectorAll('input[type="text"], input[type="search"], select, [role="combobox"]').forEach(inp => {
                         const label = inp.getAttribute('aria-label') || inp.getAttribute('placeholder') || '';
                         if (label) filters.push(label.slice(0, 50));
                     });
-                    parent = parent.parentElement;
                 }
                 
                 // Ищем кнопки сортировки
@@ -206,19 +484,10 @@ def detect_form_fields(page: Page) -> List[Dict[str, Any]]:
     Возвращает список полей с ref-id (data-agent-ref) для мгновенного поиска.
     """
     try:
-        fields = page.evaluate("""() => {
+        fields = page.evaluate("""() => {""" + _AGENT_REFS_JS + """
             const result = [];
             const seen = new WeakSet();
-            if (!window.__agentRefs) window.__agentRefs = {};
-            if (!window.__agentRefMeta) window.__agentRefMeta = {};
-            if (!window.__agentLocator) window.__agentLocator = {};
-            // Находим текущий максимальный ref
-            let maxRef = 0;
-            for (const k of Object.keys(window.__agentRefs)) {
-                const n = parseInt(k, 10);
-                if (n > maxRef) maxRef = n;
-            }
-            let refCounter = maxRef + 1;
+            let refCounter = window.__agentRefsCleanup() + 1;
 
             const vis = (el) => {
                 if (!el) return false;
@@ -289,7 +558,10 @@ def detect_form_fields(page: Page) -> List[Dict[str, Any]]:
                 };
                 if (inp.tagName === 'SELECT') {
                     field.type = 'select';
-                    field.options = Array.from(inp.options).slice(0, 10).map(opt => opt.text.trim());
+                    const opts = [];
+                    const n = Math.min(10, inp.options.length);
+                    for (let i = 0; i < n; i++) opts.push(inp.options[i].text.trim());
+                    field.options = opts;
                 }
                 result.push(field);
             };
@@ -316,307 +588,267 @@ def get_iframes_info(page: Page) -> List[Dict[str, Any]]:
     """Список iframe на странице (src, name) для контекста."""
     try:
         frames = page.evaluate("""() => {
-            return Array.from(document.querySelectorAll('iframe')).map(f => ({
-                src: (f.src || '').slice(0, 200),
-                name: (f.name || '').slice(0, 80),
-                id: (f.id || '').slice(0, 80)
-            })).filter(x => x.src || x.name);
+            const out = [];
+            document.querySelectorAll('iframe').forEach(f => {
+                if (!f.src && !f.name) return;
+                out.push({
+                    src: (f.src || '').slice(0, 200),
+                    name: (f.name || '').slice(0, 80),
+                    id: (f.id || '').slice(0, 80)
+                });
+            });
+            return out;
         }""")
         return frames or []
     except Exception:
         return []
 
 
-def get_dom_summary(page: Page, max_length: int = 8000, include_shadow_dom: bool = True) -> str:
+def _format_dom_entry(d: Dict[str, Any]) -> str:
+    """Строка описания элемента: [ref] тип "текст" атрибуты."""
+    parts = [f"[{d.get('r')}]", str(d.get("t", ""))]
+    if d.get("tx"):
+        parts.append(f'"{d["tx"]}"')
+    if d.get("id"):
+        parts.append(f"id={d['id']}")
+    if d.get("al"):
+        parts.append(f'aria="{d["al"]}"')
+    if d.get("nm"):
+        parts.append(f"name={d['nm']}")
+    if d.get("ph"):
+        parts.append(f'ph="{d["ph"]}"')
+    if d.get("dis"):
+        parts.append("DISABLED")
+    if d.get("href"):
+        parts.append(f"href={d['href']}")
+    if d.get("opts"):
+        parts.append(f"opts=[{','.join(d['opts'])}]")
+    if "chk" in d:
+        parts.append("CHECKED" if d["chk"] else "unchecked")
+    if d.get("role"):
+        parts.append(f"role={d['role']}")
+    return " ".join(parts)
+
+
+# Скрипт get_dom_summary собирается один раз при импорте, а не на каждый вызов
+_DOM_SUMMARY_JS = """
+({ includeShadow, serviceSrc, knownSig, maxElements }) => {
+    if (!window.__agentVis) return null;  // хелперы не установлены в этом документе
+    const vis = window.__agentVis, desc = window.__agentDesc;
+    const stableKey = window.__agentStableKey, canonicalLocator = window.__agentCanonicalLocator;
+    // --- Ревизия DOM: MutationObserver ставится один раз на документ ---
+    // Свои data-agent-ref не считаем; value/checked и скролл мутаций не дают —
+    // ловим их событиями. Если ревизия, URL и вьюпорт не менялись с прошлого
+    // вызова — отдаём прошлое описание без обхода DOM.
+    if (!window.__agentDomObserver) {
+        window.__agentDomRev = 0;
+        window.__agentDomCount = (records) => {
+            for (const m of records) {
+                if (m.type === 'attributes' && m.attributeName === 'data-agent-ref') continue;
+                window.__agentDomRev++;
+                return;
+            }
+        };
+        window.__agentDomObserver = new MutationObserver(records => window.__agentDomCount(records));
+        window.__agentDomObserver.observe(document.documentElement, { subtree: true, childList: true, attributes: true, characterData: true });
+        const bump = () => { window.__agentDomRev++; };
+        document.addEventListener('input', bump, true);
+        document.addEventListener('change', bump, true);
+        document.addEventListener('scroll', bump, true);
+        window.addEventListener('resize', bump);
+        // Видимость меняется и без мутаций: CSS :hover/:focus-within-меню, завершённые
+        // transition/animation, сдвиги layout после загрузки картинок/iframe/шрифтов
+        for (const type of ['pointerover', 'mouseover', 'focusin', 'transitionend', 'animationend', 'load']) {
+            document.addEventListener(type, bump, true);
+        }
+        if (document.fonts) document.fonts.addEventListener('loadingdone', bump);
+    }
+    window.__agentDomCount(window.__agentDomObserver.takeRecords());
+    const domSig = [location.href, window.__agentDomRev, window.innerWidth, window.innerHeight, includeShadow ? 1 : 0, maxElements].join('|');
+    // Ответ: {sig, items}; если у Python уже есть описание для этой сигнатуры —
+    // {sig, same: 1} без повторной передачи элементов.
+    const reply = (itemsJson) => '{"sig":' + JSON.stringify(domSig) + ',"items":' + itemsJson + '}';
+    // Мутации внутри shadow root наблюдатель документа не видит — там без кеша.
+    if (window.__agentRefs && domSig === window.__agentDomSig && !window.__agentDomHadShadow
+        && typeof window.__agentLastSummary === 'string') {
+        if (knownSig === domSig) return JSON.stringify({ sig: domSig, same: 1 });
+        return reply(window.__agentLastSummary);
+    }
+
+    // Ref-ы подключённых к документу элементов сохраняем между вызовами,
+    // освобождаем только ref-ы отсоединённых нод (и самые старые при переполнении).
+    """ + _AGENT_REFS_JS + """
+    const maxRef = window.__agentRefsCleanup();
+    // Атрибуты без живой записи (клоны через cloneNode и т.п.) снимаем
+    document.querySelectorAll('[data-agent-ref]').forEach(el => {
+        if (window.__agentRefs[parseInt(el.getAttribute('data-agent-ref'), 10)] !== el) el.removeAttribute('data-agent-ref');
+    });
+    let refCounter = maxRef + 1;
+    let hadShadow = false;
+
+
+    const result = [];
+
+    // --- Фильтры ---
+    // closest() — нативный подъём по предкам вместо JS-цикла на каждый элемент
+    const isAgentUI = (el) => !el || !!el.closest('[data-agent-host]');
+    const serviceRe = serviceSrc ? new RegExp(serviceSrc, 'i') : null;
+    // Первые max символов текста без сериализации всего поддерева (textContent)
+    const textPrefix = (el, max) => {
+        const w = document.createTreeWalker(el, NodeFilter.SHOW_TEXT);
+        let out = '';
+        while (out.length < max && w.nextNode()) out += w.currentNode.nodeValue;
+        return out.slice(0, max);
+    };
+    const isServiceElement = (el) => {
+        if (!el) return true;
+        if (!serviceRe) return false;
+        if (serviceRe.test((el.id||'')+' '+(el.className||''))) return true;
+        if (serviceRe.test(textPrefix(el, 200))) return true;
+        let cur = el.parentElement, d = 0;
+        while (cur && cur !== document.body && d < 3) {
+            if (serviceRe.test((cur.className||'')+' '+(cur.id||''))) return true;
+            cur = cur.parentElement; d++;
+        }
+        return false;
+    };
+    // --- Назначить ref элементу ---
+    // Атрибуты data-agent-ref пишем после обхода, чтобы не перемежать
+    // чтения layout (rect/computed style/innerText) с записями в DOM.
+    const pendingAttrs = [];
+    const assignRef = (el) => {
+        let ref = parseInt(el.getAttribute('data-agent-ref') || '', 10);
+        if (!ref || window.__agentRefs[ref] !== el) {
+            ref = refCounter++;
+            pendingAttrs.push([el, ref]);
+            window.__agentRefs[ref] = el;
+        }
+        try { window.__agentRefMeta[ref] = stableKey(el); } catch (e) { window.__agentRefMeta[ref] = ''; }
+        try { window.__agentLocator[ref] = canonicalLocator(el); } catch (e) { window.__agentLocator[ref] = ''; }
+        return ref;
+    };
+
+    // --- Сбор элементов ---
+    // Один проход TreeWalker на корень: отбор по объединённому селектору и
+    // попутный сбор shadow root-ов. Тип — по первой подходящей группе (порядок
+    // групп = приоритет типа); вывод группируется по типам в том же порядке.
+    // javascript:-ссылки отсекает сам селектор (могут попасть в меню через nav a).
+    const typeGroups = [
+        ['button', 'button, [role="button"], input[type="submit"], input[type="button"]'],
+        ['link', 'a[href]:not([href^="javascript:"])'],
+        ['input', 'input:not([type="hidden"]):not([type="submit"]):not([type="button"]), textarea, select'],
+        ['tab', '[role="tab"]'],
+        ['menu', '[role="menuitem"], nav a, .nav-link, .menu-item'],
+        ['modal', '[role="dialog"], [role="alertdialog"], dialog'],
+    ];
+    const interactiveSel = typeGroups.map(g => g[1]).join(', ');
+    const typeOf = (el) => {
+        for (let i = 0; i < typeGroups.length; i++) {
+            const [kind, sel] = typeGroups[i];
+            if (!el.matches(sel)) continue;
+            if (kind === 'input') {
+                const tag = el.tagName.toLowerCase();
+                return [i, tag === 'select' ? 'select' : (el.type === 'checkbox' ? 'checkbox' : (el.type === 'radio' ? 'radio' : 'input'))];
+            }
+            return [i, kind];
+        }
+        return null;
+    };
+    const seen = new WeakSet();
+    // Сначала собираем кандидатов по корням и типам (без desc/ref), лимит — потом,
+    // чтобы он не ломал приоритет типов и не прятал контролы в shadow DOM.
+    const rootBuckets = [];
+    const processRoot = (root) => {
+        if (!root) return;
+        const buckets = typeGroups.map(() => []);
+        const shadowRoots = [];
+        const tw = document.createTreeWalker(root, NodeFilter.SHOW_ELEMENT);
+        for (let el = tw.nextNode(); el; el = tw.nextNode()) {
+            if (includeShadow && el.shadowRoot) shadowRoots.push(el.shadowRoot);
+            if (seen.has(el) || !el.matches(interactiveSel)) continue;
+            const kind = typeOf(el);
+            if (!kind || !vis(el) || isAgentUI(el) || isServiceElement(el)) continue;
+            seen.add(el);
+            buckets[kind[0]].push([el, kind[1]]);
+        }
+        rootBuckets.push(buckets);
+        if (shadowRoots.length) hadShadow = true;
+        for (const sr of shadowRoots) processRoot(sr);
+    };
+    processRoot(document);
+    // Лимит по приоритету типов: сперва все кнопки всех корней, затем ссылки и т.д.
+    let budget = maxElements;
+    for (let i = 0; i < typeGroups.length; i++) {
+        for (const buckets of rootBuckets) {
+            if (buckets[i].length > budget) buckets[i].length = budget;
+            budget -= buckets[i].length;
+        }
+    }
+    for (const buckets of rootBuckets) {
+        for (const bucket of buckets) for (const [el, kind] of bucket) result.push(desc(el, kind, assignRef(el)));
+    }
+    for (const [el, ref] of pendingAttrs) el.setAttribute('data-agent-ref', String(ref));
+
+    window.__agentDomSig = domSig;
+    window.__agentDomHadShadow = hadShadow;
+    // Одна JSON-строка вместо массива объектов: дешевле сериализации CDP
+    window.__agentLastSummary = JSON.stringify(result);
+    return reply(window.__agentLastSummary);
+}
+"""
+
+
+def get_dom_summary(
+    page: Page,
+    max_length: int = 8000,
+    include_shadow_dom: bool = True,
+    max_elements: int = 400,
+) -> str:
     """
     Получить описание DOM с уникальными ref-id для каждого элемента.
     Каждому интерактивному элементу присваивается data-agent-ref="N",
     и ссылка на DOM-ноду сохраняется в window.__agentRefs[N].
     GigaChat возвращает ref:N как selector → _find_element находит элемент мгновенно.
     include_shadow_dom: обходить Shadow DOM (Web Components).
+    max_length: лимит длины описания; обрезается по целым строкам элементов.
+    max_elements: сколько элементов собрать в браузере — обход прекращается на лимите,
+    чтобы не гонять через CDP описание, которое всё равно не влезет в max_length.
     """
+    # (сигнатура DOM, элементы) последнего вызова — между шагами агента DOM часто не меняется
+    cached = getattr(page, "_agent_dom_cache", None)
     try:
-        summary = page.evaluate("""
-            (includeShadow) => {
-                // Сбрасываем предыдущие ref-ы
-                if (window.__agentRefs) {
-                    document.querySelectorAll('[data-agent-ref]').forEach(el => el.removeAttribute('data-agent-ref'));
-                }
-                window.__agentRefs = {};
-                window.__agentRefMeta = {}; // ref -> stable_key
-                window.__agentLocator = {}; // ref -> canonical locator (Playwright-friendly)
-                let refCounter = 1;
-
-                // --- Стабильный ключ элемента (одинаковый между перерисовками DOM) ---
-                // Должен совпадать со stable_key_from_attrs в src/locators.py.
-                const norm = (s) => (s || '').toString().replace(/\\s+/g, ' ').trim().toLowerCase().slice(0, 60);
-                const escAttr = (s) => String(s).replace(/\\\\/g, '\\\\\\\\').replace(/"/g, '\\\\"');
-
-                // --- Канонический локатор (для записи в дефект Jira) ---
-                // Возвращает ЧИТАЕМЫЙ Playwright-совместимый селектор.
-                // Приоритет:
-                //   1) data-testid → getByTestId('...')
-                //   2) #id → #foo (стабильный id)
-                //   3) name=...[type=...] → input[name=...]
-                //   4) aria-label → getByLabel('...')
-                //   5) role + accessible name → getByRole('button',{name:'...'})
-                //   6) placeholder → getByPlaceholder('...')
-                //   7) видимый текст (короткий) → getByText('...')
-                //   8) CSS-fallback ТОЛЬКО из «осмысленных» классов; иначе — tag.
-                //
-                // Ключевая фишка: фильтруем «случайные» CSS-классы из CSS-in-JS
-                // (styled-components, emotion): sc-fEcDHC, jsx-1234567890, css-1abc23.
-                const RANDOM_CLASS_RE = /^(?:sc-[a-z0-9]+|jsx-[0-9]+|css-[a-z0-9]+|emotion-[0-9a-z]+|tw-[0-9a-z]+|[A-Z][a-zA-Z]*__[A-Za-z0-9-]+|.{2,}-[a-z0-9]{5,})$/;
-                const isMeaningfulClass = (c) => {
-                    if (!c) return false;
-                    if (c.length < 3 || c.length > 40) return false;
-                    if (RANDOM_CLASS_RE.test(c)) return false;
-                    if (/^[A-Z][a-zA-Z]*-[a-z]+$/.test(c)) return false;  // BEM-подобный с хвостом
-                    if (/^_/.test(c)) return false;
-                    return true;
-                };
-                const isStableId = (id) => {
-                    if (!id) return false;
-                    if (id.length > 64) return false;
-                    if (/^[a-f0-9]{8,}$/i.test(id)) return false;          // hex-id
-                    if (/[0-9]{6,}/.test(id)) return false;                // длинные числа
-                    if (/^uid-|^_uid-|^id-[0-9]+|^.*--[a-z0-9]{6,}$/.test(id)) return false;
-                    if (/:r[0-9a-z]+:/i.test(id)) return false;            // React useId
-                    return true;
-                };
-                const accessibleName = (el) => {
-                    const aria = (el.getAttribute && el.getAttribute('aria-label')) || '';
-                    if (aria) return aria.replace(/\\s+/g, ' ').trim();
-                    const labelledby = (el.getAttribute && el.getAttribute('aria-labelledby')) || '';
-                    if (labelledby) {
-                        try {
-                            const ids = labelledby.split(/\\s+/);
-                            const txt = ids.map(i => (document.getElementById(i) || {}).innerText || '').join(' ').trim();
-                            if (txt) return txt.replace(/\\s+/g,' ').slice(0, 80);
-                        } catch (e) {}
-                    }
-                    if (el.tagName === 'INPUT' && el.id) {
-                        try {
-                            const lbl = document.querySelector('label[for="' + escAttr(el.id) + '"]');
-                            if (lbl && lbl.innerText) return lbl.innerText.replace(/\\s+/g,' ').trim().slice(0, 80);
-                        } catch (e) {}
-                    }
-                    return '';
-                };
-                const implicitRole = (el) => {
-                    const tag = el.tagName.toLowerCase();
-                    const explicit = (el.getAttribute && el.getAttribute('role')) || '';
-                    if (explicit) return explicit;
-                    if (tag === 'button') return 'button';
-                    if (tag === 'a' && el.getAttribute('href')) return 'link';
-                    if (tag === 'input') {
-                        const t = (el.type || 'text').toLowerCase();
-                        if (t === 'checkbox') return 'checkbox';
-                        if (t === 'radio') return 'radio';
-                        if (t === 'submit' || t === 'button') return 'button';
-                        if (t === 'search') return 'searchbox';
-                        return 'textbox';
-                    }
-                    if (tag === 'textarea') return 'textbox';
-                    if (tag === 'select') return 'combobox';
-                    if (tag === 'img') return 'img';
-                    if (tag === 'nav') return 'navigation';
-                    if (/^h[1-6]$/.test(tag)) return 'heading';
-                    return '';
-                };
-                const visibleText = (el) => {
-                    const t = (el.innerText || el.textContent || '').replace(/\\s+/g, ' ').trim();
-                    return t;
-                };
-                const canonicalLocator = (el) => {
-                    if (!el || !el.tagName) return '';
-                    const tag = el.tagName.toLowerCase();
-                    const tid = (el.getAttribute && (el.getAttribute('data-testid')
-                        || el.getAttribute('data-test-id')
-                        || el.getAttribute('data-test')
-                        || el.getAttribute('data-qa'))) || '';
-                    if (tid) return 'getByTestId(\\'' + escAttr(tid) + '\\')';
-                    if (el.id && isStableId(el.id)) return '#' + el.id;
-                    if (el.name) return tag + '[name="' + escAttr(el.name) + '"]';
-
-                    const aname = accessibleName(el);
-                    if (aname) return 'getByLabel(\\'' + escAttr(aname.slice(0, 80)) + '\\')';
-
-                    const role = implicitRole(el);
-                    const text = visibleText(el);
-                    const shortText = text.length <= 60 ? text : '';
-                    if (role && shortText) {
-                        return "getByRole('" + role + "', { name: '" + escAttr(shortText) + "' })";
-                    }
-                    const ph = el.placeholder || '';
-                    if (ph) return 'getByPlaceholder(\\'' + escAttr(ph.slice(0, 60)) + '\\')';
-                    if (shortText && shortText.length >= 2) {
-                        return 'getByText(\\'' + escAttr(shortText) + '\\')';
-                    }
-
-                    // CSS fallback: только осмысленные классы.
-                    if (typeof el.className === 'string') {
-                        const meaningful = el.className.trim().split(/\\s+/).filter(isMeaningfulClass);
-                        if (meaningful.length) return tag + '.' + meaningful.slice(0, 2).join('.');
-                    }
-                    return tag;
-                };
-
-                const stableKey = (el) => {
-                    if (!el || !el.tagName) return '';
-                    const tag = el.tagName.toLowerCase();
-                    const tid = (el.getAttribute && (el.getAttribute('data-testid')
-                        || el.getAttribute('data-test-id')
-                        || el.getAttribute('data-test')
-                        || el.getAttribute('data-qa'))) || '';
-                    if (tid) return 'tid:' + tid;
-                    if (el.id) return 'id:' + el.id;
-                    const name = el.name || '';
-                    if (name) return 'name:' + tag + ':' + name;
-                    const aria = (el.getAttribute && el.getAttribute('aria-label')) || '';
-                    if (aria) return 'aria:' + tag + ':' + norm(aria);
-                    const role = (el.getAttribute && el.getAttribute('role')) || '';
-                    const text = norm(el.innerText || el.textContent || el.value || el.placeholder || '');
-                    if (role && text) return 'role:' + role + ':' + text;
-                    if (text) return 'text:' + tag + ':' + text;
-                    const ph = el.placeholder || '';
-                    if (ph) return 'ph:' + tag + ':' + norm(ph);
-                    let cls = '';
-                    if (typeof el.className === 'string') {
-                        cls = el.className.trim().split(/\\s+/).filter(Boolean).slice(0, 2).join('.');
-                    }
-                    return cls ? ('css:' + tag + '.' + cls) : ('css:' + tag);
-                };
-
-                const result = [];
-
-                // --- Фильтры ---
-                const isAgentUI = (el) => {
-                    if (!el) return true;
-                    let cur = el;
-                    while (cur && cur !== document.body) {
-                        if (cur.hasAttribute && cur.hasAttribute('data-agent-host')) return true;
-                        cur = cur.parentElement;
-                    }
-                    return false;
-                };
-                const servicePatterns = ['chat','чат','support','поддержк','help','консультант','jivo','intercom','crisp','drift','tawk','livechat','live-chat','widget-chat','chat-widget','feedback','обратн','звонок','callback','kventin','agent-llm','agent-banner','диалог с llm','ai-тестировщик','gigachat','cookie','consent'];
-                const isServiceElement = (el) => {
-                    if (!el) return true;
-                    const combined = ((el.textContent||'')+(el.id||'')+(el.className||'')).toLowerCase();
-                    for (const p of servicePatterns) { if (combined.includes(p)) return true; }
-                    let cur = el.parentElement, d = 0;
-                    while (cur && cur !== document.body && d < 3) {
-                        const pt = ((cur.className||'')+(cur.id||'')).toLowerCase();
-                        for (const p of servicePatterns) { if (pt.includes(p)) return true; }
-                        cur = cur.parentElement; d++;
-                    }
-                    return false;
-                };
-                const inViewport = (el) => {
-                    const r = el.getBoundingClientRect();
-                    const vw = window.innerWidth, vh = window.innerHeight;
-                    return r.top < vh && r.bottom > 0 && r.left < vw && r.right > 0;
-                };
-                const ancestorsVisible = (el) => {
-                    let cur = el.parentElement;
-                    while (cur && cur !== document.body) {
-                        const s = getComputedStyle(cur);
-                        if (s.display === 'none' || s.visibility === 'hidden' || parseFloat(s.opacity) === 0) return false;
-                        cur = cur.parentElement;
-                    }
-                    return true;
-                };
-                const vis = (el) => {
-                    if (!el) return false;
-                    const r = el.getBoundingClientRect();
-                    if (r.width === 0 || r.height === 0) return false;
-                    const s = getComputedStyle(el);
-                    if (s.display === 'none' || s.visibility === 'hidden' || s.opacity === '0') return false;
-                    if (!inViewport(el) || !ancestorsVisible(el)) return false;
-                    return true;
-                };
-
-                // --- Назначить ref элементу ---
-                const assignRef = (el) => {
-                    const ref = refCounter++;
-                    el.setAttribute('data-agent-ref', String(ref));
-                    window.__agentRefs[ref] = el;
-                    try { window.__agentRefMeta[ref] = stableKey(el); } catch (e) { window.__agentRefMeta[ref] = ''; }
-                    try { window.__agentLocator[ref] = canonicalLocator(el); } catch (e) { window.__agentLocator[ref] = ''; }
-                    return ref;
-                };
-
-                // --- Описание элемента (компактное, с ref) ---
-                const desc = (el, type) => {
-                    const ref = assignRef(el);
-                    const tag = el.tagName.toLowerCase();
-                    const text = (el.textContent || el.value || el.placeholder || '').trim().replace(/\\s+/g, ' ').slice(0, 60);
-                    const parts = [`[${ref}]`, type || tag];
-                    if (text) parts.push(`"${text}"`);
-                    if (el.id) parts.push(`id=${el.id}`);
-                    if (el.getAttribute('aria-label')) parts.push(`aria="${el.getAttribute('aria-label').slice(0,40)}"`);
-                    if (el.name) parts.push(`name=${el.name}`);
-                    if (el.placeholder) parts.push(`ph="${el.placeholder.slice(0,30)}"`);
-                    if (el.disabled) parts.push('DISABLED');
-                    if (el.getAttribute('href')) parts.push(`href=${el.getAttribute('href').slice(0,60)}`);
-                    if (tag === 'select') {
-                        const opts = Array.from(el.options).slice(0,5).map(o => o.text.trim().slice(0,20));
-                        if (opts.length) parts.push(`opts=[${opts.join(',')}]`);
-                    }
-                    if (el.type === 'checkbox' || el.type === 'radio') parts.push(el.checked ? 'CHECKED' : 'unchecked');
-                    if (el.getAttribute('role')) parts.push(`role=${el.getAttribute('role')}`);
-                    return parts.join(' ');
-                };
-
-                // --- Сбор элементов ---
-                const seen = new WeakSet();
-                const collect = (el, type) => {
-                    if (!el || seen.has(el) || !vis(el) || isAgentUI(el) || isServiceElement(el)) return;
-                    seen.add(el);
-                    result.push(desc(el, type));
-                };
-
-                // Кнопки
-                document.querySelectorAll('button, [role="button"], input[type="submit"], input[type="button"]').forEach(el => collect(el, 'button'));
-                // Ссылки
-                document.querySelectorAll('a[href]').forEach(el => {
-                    if ((el.getAttribute('href')||'').startsWith('javascript:')) return;
-                    collect(el, 'link');
-                });
-                // Инпуты
-                document.querySelectorAll('input:not([type="hidden"]):not([type="submit"]):not([type="button"]), textarea, select').forEach(el => {
-                    const tag = el.tagName.toLowerCase();
-                    const type = tag === 'select' ? 'select' : (el.type === 'checkbox' ? 'checkbox' : (el.type === 'radio' ? 'radio' : 'input'));
-                    collect(el, type);
-                });
-                // Табы
-                document.querySelectorAll('[role="tab"]').forEach(el => collect(el, 'tab'));
-                // Меню
-                document.querySelectorAll('[role="menuitem"], nav a, .nav-link, .menu-item').forEach(el => collect(el, 'menu'));
-                // Модалки
-                document.querySelectorAll('[role="dialog"], [role="alertdialog"], dialog').forEach(el => collect(el, 'modal'));
-
-                const processRoot = (root) => {
-                    if (!root || root === document && result.length > 500) return;
-                    root.querySelectorAll('button, [role="button"], input[type="submit"], input[type="button"]').forEach(el => collect(el, 'button'));
-                    root.querySelectorAll('a[href]').forEach(el => { if (!(el.getAttribute('href')||'').startsWith('javascript:')) collect(el, 'link'); });
-                    root.querySelectorAll('input:not([type="hidden"]):not([type="submit"]):not([type="button"]), textarea, select').forEach(el => {
-                        const tag = el.tagName.toLowerCase();
-                        const type = tag === 'select' ? 'select' : (el.type === 'checkbox' ? 'checkbox' : (el.type === 'radio' ? 'radio' : 'input'));
-                        collect(el, type);
-                    });
-                    root.querySelectorAll('[role="tab"]').forEach(el => collect(el, 'tab'));
-                    root.querySelectorAll('[role="menuitem"], nav a, .nav-link, .menu-item').forEach(el => collect(el, 'menu'));
-                    root.querySelectorAll('[role="dialog"], [role="alertdialog"], dialog').forEach(el => collect(el, 'modal'));
-                    if (includeShadow) root.querySelectorAll('*').forEach(el => { if (el.shadowRoot) processRoot(el.shadowRoot); });
-                };
-                if (includeShadow) document.querySelectorAll('*').forEach(el => { if (el.shadowRoot) processRoot(el.shadowRoot); });
-
-                return result.join('\\n');
-            }
-        """, include_shadow_dom)
-        return (summary or "")[:max_length]
+        args = {
+            "includeShadow": include_shadow_dom,
+            "serviceSrc": _DOM_SERVICE_RE_SRC,
+            "knownSig": cached[0] if cached else None,
+            "maxElements": max_elements,
+        }
+        raw = page.evaluate(_DOM_SUMMARY_JS, args)
+        if raw is None:
+            # Страница без init-скрипта (новая вкладка и т.п.): ставим его, чтобы
+            # следующие навигации не шли через этот запасной путь
+            install_dom_helpers(page)
+            raw = page.evaluate(_DOM_SUMMARY_JS, args)
+        payload = json.loads(raw) if raw else {}
+        if payload.get("same") and cached:
+            entries = cached[1]
+        else:
+            entries = payload.get("items") or []
+            try:
+                page._agent_dom_cache = (payload.get("sig"), entries)
+            except Exception:
+                pass
+        lines: List[str] = []
+        total = 0
+        for entry in entries:
+            line = _format_dom_entry(entry)
+            total += len(line) + (1 if lines else 0)
+            if total > max_length:
+                if not lines:
+                    lines.append(line[:max_length])
+                break
+            lines.append(line)
+        return "\n".join(lines)
     except Exception as e:
         return f"[Ошибка DOM: {e}]"
 
@@ -730,37 +962,100 @@ def detect_active_overlays(page: Page) -> Dict[str, Any]:
     Чат/виджеты поддержки (jivo, intercom, crisp и т.д.) исключаются — не часть приложения.
     """
     try:
-        ignore_patterns = list(OVERLAY_IGNORE_PATTERNS) if OVERLAY_IGNORE_PATTERNS else []
         result = page.evaluate(
             """
-            (ignorePatterns) => {
-                const overlays = [];
-                // UI агента в closed Shadow DOM — невидим. Фильтр только для host-элемента.
-                const isAgentUI = (el) => {
-                    if (!el) return false;
-                    let cur = el;
-                    while (cur && cur !== document.body) {
-                        if (cur.hasAttribute && cur.hasAttribute('data-agent-host')) return true;
-                        cur = cur.parentElement;
+            (ignoreSrc) => {
+                // Селекторы оверлеев по категориям
+                const modalSels = [
+                    '[role="dialog"]', '[role="alertdialog"]', 'dialog[open]',
+                    '.modal.show', '.modal.active', '.modal.open', '.modal.visible',
+                    '.modal-dialog', '.modal-content',
+                    '[class*="modal"][class*="open"]', '[class*="modal"][class*="show"]',
+                    '[class*="modal"][class*="active"]', '[class*="modal"][class*="visible"]',
+                    '[class*="popup"][class*="open"]', '[class*="popup"][class*="show"]',
+                    '[class*="popup"][class*="active"]', '[class*="popup"][class*="visible"]',
+                    '[class*="drawer"][class*="open"]', '[class*="drawer"][class*="show"]',
+                    '[class*="overlay"][class*="open"]', '[class*="overlay"][class*="show"]',
+                    '[class*="lightbox"]',
+                    '[aria-modal="true"]'
+                ];
+                const tooltipSels = [
+                    '[role="tooltip"]', '.tooltip.show', '.tooltip.active',
+                    '[class*="tooltip"][class*="show"]', '[class*="tooltip"][class*="visible"]',
+                    '.tippy-box', '.tippy-content', '[data-tippy-root]'
+                ];
+                const ddSels = [
+                    '[role="listbox"]', '[role="menu"]:not(nav [role="menu"])',
+                    '.dropdown-menu.show', '.dropdown-menu.active', '.dropdown-menu.open',
+                    '[class*="dropdown"][class*="open"]', '[class*="dropdown"][class*="show"]',
+                    '[class*="select"][class*="open"]', '[class*="select"][class*="show"]',
+                    '[class*="listbox"]', '.autocomplete-results', '[class*="autocomplete"][class*="open"]',
+                    'ul[class*="menu"][class*="open"]', 'ul[class*="menu"][class*="show"]'
+                ];
+                const popSels = [
+                    '[role="dialog"][class*="popover"]', '.popover.show', '.popover.active',
+                    '[class*="popover"][class*="show"]', '[class*="popover"][class*="visible"]'
+                ];
+                const toastSels = [
+                    '[role="alert"]', '[role="status"]', '.toast.show',
+                    '[class*="toast"][class*="show"]', '[class*="notification"][class*="show"]',
+                    '[class*="snackbar"][class*="show"]', '[class*="alert"][class*="show"]',
+                    '.Toastify__toast', '.notistack-SnackbarContainer'
+                ];
+
+                // Быстрый выход: на большинстве страниц оверлеев нет. Один querySelector
+                // по всем категориям + кандидаты в fixed-оверлеи по классам, а для оверлеев
+                // с «безымянными» классами (Tailwind fixed inset-0 z-50, CSS-модули, backdrop,
+                // loader) — выборка elementsFromPoint по сетке 3×3 вместо полного прохода
+                // с getComputedStyle по каждому элементу. Условие — как у полного прохода ниже.
+                const positionalOverlayAt = () => {
+                    const vw = window.innerWidth, vh = window.innerHeight;
+                    for (const fx of [0.25, 0.5, 0.75]) {
+                        for (const fy of [0.25, 0.5, 0.75]) {
+                            for (const el of document.elementsFromPoint(vw * fx, vh * fy)) {
+                                const s = getComputedStyle(el);
+                                if (s.position !== 'fixed' && s.position !== 'absolute') continue;
+                                if (!(parseInt(s.zIndex) > 100)) continue;
+                                if (s.display === 'none' || s.visibility === 'hidden' || parseFloat(s.opacity) <= 0.1) continue;
+                                const r = el.getBoundingClientRect();
+                                if (r.width > 200 && r.height > 100) return true;
+                            }
+                        }
                     }
                     return false;
                 };
+                try {
+                    const quick = document.querySelector(
+                        modalSels.concat(tooltipSels, ddSels, popSels, toastSels).join(', ')
+                    );
+                    if (!quick && !document.querySelector('[class*="modal"], [class*="popup"], [class*="drawer"], [class*="overlay"]')
+                        && !positionalOverlayAt()) {
+                        return { has_overlay: false, overlays: [] };
+                    }
+                } catch (e) {}
+
+                const overlays = [];
+                // UI агента в closed Shadow DOM — невидим. Фильтр только для host-элемента.
+                const isAgentUI = (el) => !!(el && el.closest && el.closest('[data-agent-host]'));
+                // Первые max символов текста без сериализации всего поддерева (textContent)
+                const textPrefix = (el, max) => {
+                    const w = document.createTreeWalker(el, NodeFilter.SHOW_TEXT);
+                    let out = '';
+                    while (out.length < max && w.nextNode()) out += w.currentNode.nodeValue;
+                    return out.slice(0, max);
+                };
+                const ignoreRe = ignoreSrc ? new RegExp(ignoreSrc, 'i') : null;
                 const isChatOrSupport = (el) => {
-                    if (!el || !ignorePatterns || !ignorePatterns.length) return false;
+                    if (!el || !ignoreRe) return false;
                     // Сначала проверяем: это UI агента?
                     if (isAgentUI(el)) return true;
-                    const check = (s) => {
-                        if (!s || typeof s !== 'string') return false;
-                        const low = s.toLowerCase();
-                        return ignorePatterns.some(p => low.indexOf(p) !== -1);
-                    };
+                    const check = (s) => !!s && typeof s === 'string' && ignoreRe.test(s);
                     let cur = el;
                     for (let i = 0; i < 10 && cur; i++) {
                         if (check(cur.id) || check(cur.className && cur.className.toString()) || check(cur.getAttribute('aria-label') || '')) return true;
                         cur = cur.parentElement;
                     }
-                    const text = (el.textContent || '').trim().toLowerCase().slice(0, 500);
-                    return ignorePatterns.some(p => text.indexOf(p) !== -1);
+                    return ignoreRe.test(textPrefix(el, 500).trim());
                 };
                 const vis = (el) => {
                     if (!el) return false;
@@ -769,40 +1064,43 @@ def detect_active_overlays(page: Page) -> Dict[str, Any]:
                     const s = getComputedStyle(el);
                     return s.display !== 'none' && s.visibility !== 'hidden' && parseFloat(s.opacity) > 0.1;
                 };
+                // Максимальный z-index по цепочке предков. Результат кешируется для каждого
+                // пройденного предка, так что общие предки кандидатов считаются один раз.
+                const zCache = new WeakMap();
                 const zOf = (el) => {
-                    let z = 0;
-                    let cur = el;
+                    const chain = [];
+                    let cur = el, z = 0;
                     while (cur && cur !== document.body) {
-                        const zi = parseInt(getComputedStyle(cur).zIndex);
-                        if (!isNaN(zi) && zi > z) z = zi;
+                        const hit = zCache.get(cur);
+                        if (hit !== undefined) { z = hit; break; }
+                        chain.push(cur);
                         cur = cur.parentElement;
                     }
+                    for (let i = chain.length - 1; i >= 0; i--) {
+                        const zi = parseInt(getComputedStyle(chain[i]).zIndex);
+                        if (!isNaN(zi) && zi > z) z = zi;
+                        zCache.set(chain[i], z);
+                    }
                     return z;
                 };
                 const textOf = (el, max) => (el.textContent || '').trim().replace(/\\s+/g, ' ').slice(0, max || 150);
+                // Один querySelectorAll на категорию (объединённый список селекторов).
+                // Если какой-то селектор не поддерживается движком — поштучный обход.
+                const forEachMatch = (sels, fn) => {
+                    try {
+                        document.querySelectorAll(sels.join(', ')).forEach(fn);
+                        return;
+                    } catch (e) {}
+                    for (const sel of sels) {
+                        try { document.querySelectorAll(sel).forEach(fn); } catch (e) {}
+                    }
+                };
 
                 // --- Модалки / Диалоги ---
-                const modalSels = [
-                    '[role="dialog"]', '[role="alertdialog"]', 'dialog[open]',
-                    '.modal.show', '.modal.active', '.modal.open', '.modal.visible',
-                    '.modal-dialog', '.modal-content',
-                    '[class*="modal"][class*="open"]', '[class*="modal"][class*="show"]',
-                    '[class*="modal"][class*="active"]', '[class*="modal"][class*="visible"]',
-                    '[class*="popup"][class*="open"]', '[class*="popup"][class*="show"]',
-                    '[class*="popup"][class*="active"]', '[class*="popup"][class*="visible"]',
-                    '[class*="drawer"][class*="open"]', '[class*="drawer"][class*="show"]',
-                    '[class*="overlay"][class*="open"]', '[class*="overlay"][class*="show"]',
-                    '[class*="lightbox"]',
-                    '[aria-modal="true"]'
-                ];
                 const modalEls = new Set();
-                for (const sel of modalSels) {
-                    try {
-                        document.querySelectorAll(sel).forEach(el => {
-                            if (vis(el) && zOf(el) > 10) modalEls.add(el);
-                        });
-                    } catch(e) {}
-                }
+                forEachMatch(modalSels, el => {
+                    if (vis(el) && zOf(el) > 10) modalEls.add(el);
+                });
                 // Ещё: элементы с position:fixed/absolute и высоким z-index
                 document.querySelectorAll('*').forEach(el => {
                     if (modalEls.has(el)) return;
@@ -838,10 +1136,8 @@ def detect_active_overlays(page: Page) -> Dict[str, Any]:
                     const closeBtn = el.querySelector('[aria-label*="close" i], [aria-label*="закрыть" i], [class*="close"], [class*="dismiss"], button.close, .modal-close, [data-dismiss="modal"], [data-bs-dismiss="modal"]');
                     if (closeBtn && vis(closeBtn)) {
                         let closeRef = closeBtn.getAttribute('data-agent-ref');
-                        if (!closeRef && window.__agentRefs) {
-                            let maxR = 0;
-                            for (const k of Object.keys(window.__agentRefs)) { const n = parseInt(k); if (n > maxR) maxR = n; }
-                            closeRef = String(maxR + 1);
+                        if (!closeRef && window.__agentRefsCleanup) {
+                            closeRef = String(window.__agentRefsCleanup() + 1);
                             closeBtn.setAttribute('data-agent-ref', closeRef);
                             window.__agentRefs[parseInt(closeRef)] = closeBtn;
                         }
@@ -851,82 +1147,51 @@ def detect_active_overlays(page: Page) -> Dict[str, Any]:
                 });
 
                 // --- Тултипы ---
-                const tooltipSels = [
-                    '[role="tooltip"]', '.tooltip.show', '.tooltip.active',
-                    '[class*="tooltip"][class*="show"]', '[class*="tooltip"][class*="visible"]',
-                    '.tippy-box', '.tippy-content', '[data-tippy-root]'
-                ];
-                for (const sel of tooltipSels) {
-                    try {
-                        document.querySelectorAll(sel).forEach(el => {
-                            if (vis(el) && !isAgentUI(el) && !isChatOrSupport(el)) overlays.push({ type: 'tooltip', text: textOf(el, 120) });
-                        });
-                    } catch(e) {}
-                }
+                forEachMatch(tooltipSels, el => {
+                    if (vis(el) && !isAgentUI(el) && !isChatOrSupport(el)) overlays.push({ type: 'tooltip', text: textOf(el, 120) });
+                });
 
                 // --- Дропдауны ---
-                const ddSels = [
-                    '[role="listbox"]', '[role="menu"]:not(nav [role="menu"])',
-                    '.dropdown-menu.show', '.dropdown-menu.active', '.dropdown-menu.open',
-                    '[class*="dropdown"][class*="open"]', '[class*="dropdown"][class*="show"]',
-                    '[class*="select"][class*="open"]', '[class*="select"][class*="show"]',
-                    '[class*="listbox"]', '.autocomplete-results', '[class*="autocomplete"][class*="open"]',
-                    'ul[class*="menu"][class*="open"]', 'ul[class*="menu"][class*="show"]'
-                ];
-                for (const sel of ddSels) {
-                    try {
-                        document.querySelectorAll(sel).forEach(el => {
-                            if (vis(el) && zOf(el) > 5 && !isAgentUI(el) && !isChatOrSupport(el)) {
-                                const items = [];
-                                el.querySelectorAll('[role="option"], [role="menuitem"], li, a').forEach(li => {
-                                    if (vis(li)) items.push(textOf(li, 40));
-                                });
-                                overlays.push({ type: 'dropdown', text: textOf(el, 100), items: items.slice(0, 10) });
-                            }
+                forEachMatch(ddSels, el => {
+                    if (vis(el) && zOf(el) > 5 && !isAgentUI(el) && !isChatOrSupport(el)) {
+                        const items = [];
+                        el.querySelectorAll('[role="option"], [role="menuitem"], li, a').forEach(li => {
+                            if (vis(li)) items.push(textOf(li, 40));
                         });
-                    } catch(e) {}
-                }
+                        overlays.push({ type: 'dropdown', text: textOf(el, 100), items: items.slice(0, 10) });
+                    }
+                });
 
                 // --- Поповеры ---
-                const popSels = [
-                    '[role="dialog"][class*="popover"]', '.popover.show', '.popover.active',
-                    '[class*="popover"][class*="show"]', '[class*="popover"][class*="visible"]'
-                ];
-                for (const sel of popSels) {
-                    try {
-                        document.querySelectorAll(sel).forEach(el => {
-                            if (vis(el) && !isAgentUI(el) && !isChatOrSupport(el)) overlays.push({ type: 'popover', text: textOf(el, 150) });
-                        });
-                    } catch(e) {}
-                }
+                forEachMatch(popSels, el => {
+                    if (vis(el) && !isAgentUI(el) && !isChatOrSupport(el)) overlays.push({ type: 'popover', text: textOf(el, 150) });
+                });
 
                 // --- Уведомления / Тосты ---
-                const toastSels = [
-                    '[role="alert"]', '[role="status"]', '.toast.show',
-                    '[class*="toast"][class*="show"]', '[class*="notification"][class*="show"]',
-                    '[class*="snackbar"][class*="show"]', '[class*="alert"][class*="show"]',
-                    '.Toastify__toast', '.notistack-SnackbarContainer'
-                ];
-                for (const sel of toastSels) {
-                    try {
-                        document.querySelectorAll(sel).forEach(el => {
-                            if (vis(el) && !isAgentUI(el) && !isChatOrSupport(el)) overlays.push({ type: 'notification', text: textOf(el, 120) });
-                        });
-                    } catch(e) {}
-                }
+                forEachMatch(toastSels, el => {
+                    if (vis(el) && !isAgentUI(el) && !isChatOrSupport(el)) overlays.push({ type: 'notification', text: textOf(el, 120) });
+                });
 
-                // Дедупликация
+                // Дедупликация по 32-битному FNV-1a от (type, первые 50 символов text):
+                // без промежуточных строк-ключей, в Set лежат числа.
+                const fnv = (h, s, max) => {
+                    const n = Math.min(s.length, max);
+                    for (let i = 0; i < n; i++) { h ^= s.charCodeAt(i); h = Math.imul(h, 16777619); }
+                    return h;
+                };
                 const seen = new Set();
                 const unique = [];
                 for (const o of overlays) {
-                    const k = o.type + '|' + (o.text || '').slice(0, 50);
+                    let h = fnv(2166136261, o.type, 32);
+                    h = Math.imul(h ^ 124, 16777619);  // разделитель '|'
+                    const k = fnv(h, o.text || '', 50) >>> 0;
                     if (!seen.has(k)) { seen.add(k); unique.push(o); }
                 }
 
                 return { has_overlay: unique.length > 0, overlays: unique.slice(0, 8) };
             }
         """,
-            ignore_patterns,
+            _OVERLAY_IGNORE_RE_SRC,
         )
         return result or {"has_overlay": False, "overlays": []}
     except Exception as e:
@@ -957,6 +1222,20 @@ def format_overlays_context(overlay_info: Dict[str, Any]) -> str:
     return "\n".join(lines)
 
 
+def _same_context_key(old: tuple, new: tuple) -> bool:
+    """Сравнить ключи build_context: записи логов — по идентичности объекта, остальное — по значению."""
+    return (
+        old[0] == new[0] and old[1] == new[1]
+        and old[2] == new[2] and old[3] is new[3]
+        and old[4] == new[4] and old[5] is new[5]
+    )
+
+
+# Строки консоли/сети для build_context; обрезка текста — точностью формата ({:.200})
+_CONSOLE_LINE = "  [{}] {:.200}".format
+_NETWORK_LINE = "  {} {:.150}".format
+
+
 def build_context(
     page: Page,
     current_url: str,
@@ -965,36 +1244,63 @@ def build_context(
 ) -> str:
     """
     Собрать текстовый контекст страницы для GigaChat: консоль, сеть, DOM.
+    Если URL, описание DOM и хвосты логов не изменились с прошлого вызова —
+    возвращается прошлый текст без повторной фильтрации и сборки.
     """
+    dom = get_dom_summary(page)
+    # Логи только дописываются (и изредка обрезаются с начала): длина + последняя запись
+    key = (
+        current_url,
+        dom,
+        len(console_log), console_log[-1] if console_log else None,
+        len(network_failures), network_failures[-1] if network_failures else None,
+    )
+    cached = getattr(page, "_agent_ctx_cache", None)
+    if cached and _same_context_key(cached[0], key):
+        return cached[1]
+
     lines = [f"Текущий URL: {current_url}", ""]
 
     if console_log:
-        filtered = [c for c in console_log if not _should_ignore_console(c.get("text", ""))]
-        if filtered:
+        # Идём с конца и останавливаемся на 20 подходящих — вся история не фильтруется
+        tail = list(islice(
+            (c for c in reversed(console_log) if not _should_ignore_console(c.get("text", ""))),
+            20,
+        ))
+        if tail:
             lines.append("Консоль (важные сообщения):")
-            for entry in filtered[-20:]:
-                lines.append(f"  [{entry.get('type', 'log')}] {entry.get('text', '')[:200]}")
+            lines.append("\n".join(
+                _CONSOLE_LINE(entry.get("type", "log"), entry.get("text", "")) for entry in reversed(tail)
+            ))
             lines.append("")
 
     if network_failures:
-        filtered = [
-            n for n in network_failures
-            if not _should_ignore_network(n.get("url", ""), n.get("status"))
-        ]
-        if filtered:
+        tail = list(islice(
+            (
+                n for n in reversed(network_failures)
+                if not _should_ignore_network(n.get("url", ""), n.get("status"))
+            ),
+            15,
+        ))
+        if tail:
             lines.append("Сеть (ошибки запросов):")
-            for entry in filtered[-15:]:
-                lines.append(f"  {entry.get('status')} {entry.get('url', '')[:150]}")
+            lines.append("\n".join(
+                _NETWORK_LINE(entry.get("status"), entry.get("url", "")) for entry in reversed(tail)
+            ))
             lines.append("")
 
-    dom = get_dom_summary(page)
     if dom:
         lines.append("ЭЛЕМЕНТЫ (формат [ref] тип \"текст\" атрибуты — используй ref:N как selector):")
         lines.append(dom[:4000])
         if len(dom) > 4000:
             lines.append("... (обрезано)")
 
-    return "\n".join(lines)
+    text = "\n".join(lines)
+    try:
+        page._agent_ctx_cache = (key, text)
+    except Exception:
+        pass
+    return text
 
 
 def get_page_resource_urls(page: Page, base_url: str) -> List[str]:
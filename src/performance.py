@@ -1,8 +1,9 @@
 """
 Performance-мониторинг: время загрузки, размер ресурсов, тяжёлые запросы.
 """
+import json
 import logging
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
 
 from playwright.sync_api import Page
 
@@ -14,111 +15,115 @@ SLOW_RESOURCE_MS = 3000        # один ресурс грузится доль
 LARGE_RESOURCE_KB = 2048       # ресурс > 2 МБ
 
 
+# Все метрики одним evaluate: navigation timing, ресурсы (один проход по
+# getEntriesByType('resource')) и память. Результат — JSON-строка, чтобы не
+# гонять через CDP сериализацию вложенных объектов.
+_METRICS_JS = """(th) => {
+    const t = performance.timing || {};
+    const nav = performance.getEntriesByType('navigation')[0] || {};
+    const slow = [], large = [];
+    for (const e of performance.getEntriesByType('resource')) {
+        if (slow.length < 10 && e.duration > th.slowMs) {
+            slow.push({ name: e.name.slice(0, 120), duration: Math.round(e.duration), type: e.initiatorType });
+        }
+        if (large.length < 10 && e.transferSize > th.largeBytes) {
+            large.push({ name: e.name.slice(0, 120), size: Math.round(e.transferSize / 1024), type: e.initiatorType });
+        }
+    }
+    const mem = performance.memory ? {
+        usedJSHeapSize: Math.round(performance.memory.usedJSHeapSize / 1024 / 1024),
+        totalJSHeapSize: Math.round(performance.memory.totalJSHeapSize / 1024 / 1024),
+        jsHeapSizeLimit: Math.round(performance.memory.jsHeapSizeLimit / 1024 / 1024),
+    } : null;
+    return JSON.stringify({
+        timing: {
+            domContentLoaded: nav.domContentLoadedEventEnd || (t.domContentLoadedEventEnd - t.navigationStart),
+            loadComplete: nav.loadEventEnd || (t.loadEventEnd - t.navigationStart),
+            domInteractive: nav.domInteractive || (t.domInteractive - t.navigationStart),
+            ttfb: nav.responseStart || (t.responseStart - t.navigationStart),
+        },
+        slowResources: slow,
+        largeResources: large,
+        memory: mem,
+    });
+}"""
+_METRICS_THRESHOLDS = {"slowMs": SLOW_RESOURCE_MS, "largeBytes": LARGE_RESOURCE_KB * 1024}
+
+
 def check_performance(page: Page) -> List[Dict[str, Any]]:
     """
     Собрать метрики производительности. Возвращает список issue:
     [{"type": "performance", "severity": ..., "rule": ..., "detail": ...}]
     """
+    metrics = _collect_metrics(page)
+    if not metrics:
+        return []
     issues = []
-    issues.extend(_check_page_load_time(page))
-    issues.extend(_check_slow_resources(page))
-    issues.extend(_check_large_resources(page))
-    issues.extend(_check_memory_usage(page))
+    issues.extend(_check_page_load_time(metrics.get("timing") or {}))
+    issues.extend(_check_slow_resources(metrics.get("slowResources") or []))
+    issues.extend(_check_large_resources(metrics.get("largeResources") or []))
+    issues.extend(_check_memory_usage(metrics.get("memory")))
     return issues
 
 
-def _check_page_load_time(page: Page) -> List[Dict]:
-    """Время загрузки страницы (navigation timing)."""
+def _collect_metrics(page: Page) -> Dict[str, Any]:
+    """Снять все метрики страницы за один page.evaluate."""
     try:
-        timing = page.evaluate("""() => {
-            const t = performance.timing || {};
-            const nav = performance.getEntriesByType('navigation')[0] || {};
-            return {
-                domContentLoaded: nav.domContentLoadedEventEnd || (t.domContentLoadedEventEnd - t.navigationStart),
-                loadComplete: nav.loadEventEnd || (t.loadEventEnd - t.navigationStart),
-                domInteractive: nav.domInteractive || (t.domInteractive - t.navigationStart),
-                ttfb: nav.responseStart || (t.responseStart - t.navigationStart),
-            };
-        }""")
-        issues = []
-        load_time = timing.get("loadComplete", 0)
-        ttfb = timing.get("ttfb", 0)
-        if load_time > SLOW_PAGE_LOAD_MS:
-            issues.append({
-                "type": "performance", "severity": "warning", "rule": "slow-page-load",
-                "detail": f"Страница загружается {load_time}мс (порог {SLOW_PAGE_LOAD_MS}мс). TTFB={ttfb}мс",
-            })
-        if ttfb > 2000:
-            issues.append({
-                "type": "performance", "severity": "warning", "rule": "slow-ttfb",
-                "detail": f"Время до первого байта (TTFB): {ttfb}мс (> 2с)",
-            })
-        return issues
+        raw = page.evaluate(_METRICS_JS, _METRICS_THRESHOLDS)
+        return json.loads(raw) if raw else {}
     except Exception as e:
-        LOG.debug("page-load check: %s", e)
-        return []
+        LOG.debug("performance metrics: %s", e)
+        return {}
 
 
-def _check_slow_resources(page: Page) -> List[Dict]:
+def _check_page_load_time(timing: Dict[str, Any]) -> List[Dict]:
+    """Время загрузки страницы (navigation timing)."""
+    issues = []
+    load_time = timing.get("loadComplete") or 0
+    ttfb = timing.get("ttfb") or 0
+    if load_time > SLOW_PAGE_LOAD_MS:
+        issues.append({
+            "type": "performance", "severity": "warning", "rule": "slow-page-load",
+            "detail": f"Страница загружается {load_time}мс (порог {SLOW_PAGE_LOAD_MS}мс). TTFB={ttfb}мс",
+        })
+    if ttfb > 2000:
+        issues.append({
+            "type": "performance", "severity": "warning", "rule": "slow-ttfb",
+            "detail": f"Время до первого байта (TTFB): {ttfb}мс (> 2с)",
+        })
+    return issues
+
+
+def _check_slow_resources(entries: List[Dict[str, Any]]) -> List[Dict]:
     """Медленные ресурсы (> 3с)."""
-    try:
-        entries = page.evaluate(f"""() => {{
-            return performance.getEntriesByType('resource')
-                .filter(e => e.duration > {SLOW_RESOURCE_MS})
-                .map(e => ({{ name: e.name.slice(0, 120), duration: Math.round(e.duration), type: e.initiatorType }}))
-                .slice(0, 10);
-        }}""")
-        return [
-            {"type": "performance", "severity": "warning", "rule": "slow-resource",
-             "detail": f"Медленный ресурс ({e.get('duration')}мс): {e.get('name', '')[:80]}"}
-            for e in (entries or [])
-        ]
-    except Exception as e:
-        LOG.debug("slow-resource check: %s", e)
-        return []
+    return [
+        {"type": "performance", "severity": "warning", "rule": "slow-resource",
+         "detail": f"Медленный ресурс ({e.get('duration')}мс): {e.get('name', '')[:80]}"}
+        for e in entries
+    ]
 
 
-def _check_large_resources(page: Page) -> List[Dict]:
+def _check_large_resources(entries: List[Dict[str, Any]]) -> List[Dict]:
     """Тяжёлые ресурсы (> 2 МБ)."""
-    try:
-        entries = page.evaluate(f"""() => {{
-            return performance.getEntriesByType('resource')
-                .filter(e => e.transferSize > {LARGE_RESOURCE_KB * 1024})
-                .map(e => ({{ name: e.name.slice(0, 120), size: Math.round(e.transferSize / 1024), type: e.initiatorType }}))
-                .slice(0, 10);
-        }}""")
-        return [
-            {"type": "performance", "severity": "warning", "rule": "large-resource",
-             "detail": f"Тяжёлый ресурс ({e.get('size')}КБ): {e.get('name', '')[:80]}"}
-            for e in (entries or [])
-        ]
-    except Exception as e:
-        LOG.debug("large-resource check: %s", e)
-        return []
+    return [
+        {"type": "performance", "severity": "warning", "rule": "large-resource",
+         "detail": f"Тяжёлый ресурс ({e.get('size')}КБ): {e.get('name', '')[:80]}"}
+        for e in entries
+    ]
 
 
-def _check_memory_usage(page: Page) -> List[Dict]:
+def _check_memory_usage(mem: Optional[Dict[str, Any]]) -> List[Dict]:
     """Использование памяти (если доступно)."""
-    try:
-        mem = page.evaluate("""() => {
-            if (performance.memory) {
-                return {
-                    usedJSHeapSize: Math.round(performance.memory.usedJSHeapSize / 1024 / 1024),
-                    totalJSHeapSize: Math.round(performance.memory.totalJSHeapSize / 1024 / 1024),
-                    jsHeapSizeLimit: Math.round(performance.memory.jsHeapSizeLimit / 1024 / 1024),
-                };
-            }
-            return null;
-        }""")
-        if mem and mem.get("usedJSHeapSize", 0) > 200:
-            return [{
-                "type": "performance", "severity": "warning", "rule": "high-memory",
-                "detail": f"Высокое потребление памяти: {mem['usedJSHeapSize']}МБ (лимит {mem.get('jsHeapSizeLimit', '?')}МБ)",
-            }]
-        return []
-    except Exception as e:
-        LOG.debug("memory check: %s", e)
-        return []
+    if mem and (mem.get("usedJSHeapSize") or 0) > 200:
+        return [{
+            "type": "performance", "severity": "warning", "rule": "high-memory",
+            "detail": f"Высокое потребление памяти: {mem['usedJSHeapSize']}МБ (лимит {mem.get('jsHeapSizeLimit', '?')}МБ)",
+        }]
+    return []
+
+
+# Строка issue; detail обрезается точностью формата
+_ISSUE_LINE = "  [{}] {}: {:.100}".format
 
 
 def format_performance_issues(issues: List[Dict]) -> str:
@@ -126,5 +131,5 @@ def format_performance_issues(issues: List[Dict]) -> str:
         return ""
     lines = [f"Performance: найдено {len(issues)} проблем(ы):"]
     for i in issues[:10]:
-        lines.append(f"  [{i.get('severity', '?').upper()}] {i.get('rule', '?')}: {i.get('detail', '')[:100]}")
+        lines.append(_ISSUE_LINE(i.get("severity", "?").upper(), i.get("rule", "?"), i.get("detail", "")))
     return "\n".join(lines)
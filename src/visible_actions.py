@@ -89,6 +89,8 @@ def safe_highlight(locator: Locator, page: Page, duration_sec: float = None) ->
 
 
 def highlight_and_click(locator: Locator, page: Page, description: str = "") -> None:
-    """Скролл к элементу + обычный клик. Без визуальных эффектов."""
-    scroll_to_center(locator, page)
+    """
+    Обычный клик без визуальных эффектов. Отдельный скролл не нужен: click() сам
+    доводит элемент до зоны видимости в рамках проверок actionability — один вызов вместо двух.
+    """
     locator.click()
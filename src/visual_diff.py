@@ -4,17 +4,84 @@ Visual diff: сравнение скриншотов до и после дейс
 """
 import base64
 import logging
-from typing import Optional, Tuple, Dict
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Optional, Tuple, Dict, Union
 
 LOG = logging.getLogger("VisualDiff")
 
+# Ширина, до которой уменьшаются скриншоты перед попиксельным сравнением
+_DIFF_MAX_WIDTH = 640
+
+# Рабочие буферы numpy для разницы (ключ — слот, форма, dtype): размер скриншотов
+# в сессии постоянный, и один набор переиспользуется между вызовами вместо
+# выделения нескольких массивов размером с картинку на каждое сравнение.
+_SCRATCH: Dict[Tuple, Any] = {}
+_SCRATCH_LOCK = threading.Lock()
+_SCRATCH_MAX = 8
+
+
+def _scratch(slot: str, shape: Tuple[int, ...], dtype):
+    """Буфер под слот/форму/тип; вызывать под _SCRATCH_LOCK."""
+    import numpy as np
+
+    key = (slot, shape, np.dtype(dtype).str)
+    buf = _SCRATCH.get(key)
+    if buf is None:
+        if len(_SCRATCH) >= _SCRATCH_MAX:
+            _SCRATCH.clear()
+        buf = _SCRATCH[key] = np.empty(shape, dtype)
+    return buf
+
+
+# Скриншот: сырые байты PNG (как отдаёт page.screenshot()) или base64-строка
+Screenshot = Union[str, bytes, bytearray, memoryview]
+
+
+def _png_bytes(data: Screenshot) -> bytes:
+    """Байты PNG: сырые отдаются как есть, base64 декодируется."""
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        return data
+    return base64.b64decode(data)
+
+
+def _open_rgb(data: Screenshot):
+    """Декодировать PNG (байты или base64) в RGB-изображение PIL (без лишней копии, если уже RGB)."""
+    from io import BytesIO
+    from PIL import Image
+
+    img = Image.open(BytesIO(_png_bytes(data)))
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    img.load()  # open() ленив — декодируем здесь, в потоке вызывающего
+    return img
+
+
+# Два PNG декодируются параллельно: zlib/libpng в Pillow отпускают GIL.
+# Пул общий на модуль — без создания потоков на каждое сравнение.
+_DECODE_POOL: Optional[ThreadPoolExecutor] = None
+_DECODE_POOL_LOCK = threading.Lock()
+
+
+def _open_rgb_pair(a: Screenshot, b: Screenshot):
+    """Декодировать оба скриншота: второй — в фоновом потоке, первый — в текущем."""
+    global _DECODE_POOL
+    if _DECODE_POOL is None:
+        with _DECODE_POOL_LOCK:
+            if _DECODE_POOL is None:
+                _DECODE_POOL = ThreadPoolExecutor(max_workers=2, thread_name_prefix="visual-diff")
+    fut = _DECODE_POOL.submit(_open_rgb, b)
+    img_a = _open_rgb(a)
+    return img_a, fut.result()
+
 
 def compute_screenshot_diff(
-    before_b64: Optional[str],
-    after_b64: Optional[str],
+    before_b64: Optional[Screenshot],
+    after_b64: Optional[Screenshot],
 ) -> Dict:
     """
-    Сравнить два скриншота (base64 PNG).
+    Сравнить два скриншота (PNG: сырые байты или base64). Сырые байты от
+    page.screenshot() можно передавать напрямую — без кодирования/декодирования base64.
     Возвращает:
     {
         "changed": bool,
@@ -30,28 +97,41 @@ def compute_screenshot_diff(
         return {"changed": False, "change_percent": 0.0, "diff_zone": "none", "detail": "идентичные скриншоты"}
 
     try:
-        from io import BytesIO
         from PIL import Image
         import numpy as np
 
-        img1 = Image.open(BytesIO(base64.b64decode(before_b64))).convert("RGB")
-        img2 = Image.open(BytesIO(base64.b64decode(after_b64))).convert("RGB")
+        img1, img2 = _open_rgb_pair(before_b64, after_b64)
 
-        # Привести к одинаковому размеру
+        # Привести к одинаковому размеру. BOX (усреднение по площади) вместо LANCZOS:
+        # для подсчёта доли изменённых пикселей точности хватает, а ядро в разы дешевле
         if img1.size != img2.size:
-            img2 = img2.resize(img1.size, Image.LANCZOS)
+            img2 = img2.resize(img1.size, Image.BOX)
 
-        arr1 = np.array(img1, dtype=float)
-        arr2 = np.array(img2, dtype=float)
+        # Для классификации по 5 корзинам полное разрешение не нужно: уменьшаем
+        # усреднением (целый коэффициент, до ~_DIFF_MAX_WIDTH по ширине) — в разы
+        # меньше пикселей на разницу, а шум сглаживания/курсора отфильтровывается
+        factor = img1.width // _DIFF_MAX_WIDTH
+        if factor > 1:
+            img1 = img1.reduce(factor)
+            img2 = img2.reduce(factor)
 
-        # Попиксельная разница
-        diff = np.abs(arr1 - arr2)
-        pixel_diff = diff.mean(axis=2)  # средняя по RGB
+        arr1 = np.asarray(img1, dtype=np.uint8)
+        arr2 = np.asarray(img2, dtype=np.uint8)
 
-        # Порог: пиксель считается изменённым, если разница > 30
+        # Порог: пиксель считается изменённым, если средняя по RGB разница > 30
+        # (то же, что сумма > 90 — без деления на каждый пиксель)
         threshold = 30
-        changed_pixels = (pixel_diff > threshold).sum()
-        total_pixels = pixel_diff.size
+        with _SCRATCH_LOCK:
+            # |a - b| без расширения типа: max(a, b) - min(a, b) в uint8 не переполняется
+            # (вычитание с насыщением, как psubusb) — байт на канал вместо двух у int16
+            diff = np.maximum(arr1, arr2, out=_scratch("hi", arr1.shape, np.uint8))
+            lo = np.minimum(arr1, arr2, out=_scratch("lo", arr1.shape, np.uint8))
+            np.subtract(diff, lo, out=diff)
+            # Сумма по RGB (не больше 765 — влезает в uint16)
+            pixel_diff = diff.sum(axis=2, dtype=np.uint16, out=_scratch("sum", arr1.shape[:2], np.uint16))
+            mask = np.greater(pixel_diff, threshold * 3, out=_scratch("mask", arr1.shape[:2], np.bool_))
+            changed_pixels = int(np.count_nonzero(mask))
+            total_pixels = mask.size
         change_pct = (changed_pixels / total_pixels) * 100
 
         if change_pct < 0.5:
@@ -79,8 +159,8 @@ def compute_screenshot_diff(
     except ImportError:
         LOG.debug("visual_diff: numpy/Pillow не установлены, сравнение по хешу")
         import hashlib
-        h1 = hashlib.md5(before_b64[:5000].encode()).hexdigest()
-        h2 = hashlib.md5(after_b64[:5000].encode()).hexdigest()
+        h1 = hashlib.md5(_png_bytes(before_b64)[:3750]).hexdigest()
+        h2 = hashlib.md5(_png_bytes(after_b64)[:3750]).hexdigest()
         changed = h1 != h2
         return {
             "changed": changed,
@@ -2,6 +2,7 @@
 Умное ожидание загрузки страниц и элементов.
 """
 import time
+import warnings
 from typing import Optional
 
 from playwright.sync_api import Page
@@ -58,23 +59,60 @@ def wait_for_selector(
         return False
 
 
-def wait_for_dom_stable(page: Page, poll_interval: float = 0.2, stable_for_ms: float = 300) -> None:
+# Промис в странице: резолвится после quietMs без мутаций (или по maxMs, если DOM
+# не успокаивается — анимации, тикеры). На тихой странице — ровно через quietMs.
+# childOnly: только структурные изменения (childList) — style/текст анимаций и
+# таймеров не мешают странице «успокоиться».
+_DOM_QUIET_JS = """({ quietMs, maxMs, childOnly }) => new Promise(resolve => {
+    const root = document.body || document.documentElement;
+    if (!root) { resolve(); return; }
+    let timer = null;
+    const done = () => { clearTimeout(timer); clearTimeout(cap); obs.disconnect(); resolve(); };
+    const obs = new MutationObserver(() => { clearTimeout(timer); timer = setTimeout(done, quietMs); });
+    const cap = setTimeout(done, maxMs);
+    obs.observe(root, childOnly
+        ? { childList: true, subtree: true }
+        : { childList: true, subtree: true, attributes: true, characterData: true });
+    timer = setTimeout(done, quietMs);
+})"""
+
+
+def wait_for_dom_stable(
+    page: Page,
+    poll_interval: Optional[float] = None,
+    stable_for_ms: float = 300,
+    timeout: float = 3000,
+    structural_only: bool = True,
+) -> None:
     """
-    Простая проверка стабильности DOM: два снимка с интервалом stable_for_ms,
-    если body.innerHTML не изменился — считаем DOM стабильным.
+    Дождаться стабильности DOM: stable_for_ms без мутаций (MutationObserver в странице),
+    но не дольше timeout мс. Один evaluate вместо двух снимков body.innerHTML.
+    structural_only (по умолчанию): учитывать только добавление/удаление узлов — смена
+    style/class от анимаций иначе не даёт DOM «затихнуть» до timeout.
+    poll_interval устарел и игнорируется (опроса больше нет).
     """
+    if poll_interval is not None:
+        warnings.warn(
+            "wait_for_dom_stable: poll_interval больше не используется и будет удалён",
+            DeprecationWarning,
+            stacklevel=2,
+        )
     try:
-        prev = page.evaluate("() => document.body ? document.body.innerHTML.length : 0")
-        time.sleep(stable_for_ms / 1000.0)
-        curr = page.evaluate("() => document.body ? document.body.innerHTML.length : 0")
-        if prev != curr:
-            time.sleep(poll_interval)
+        page.evaluate(_DOM_QUIET_JS, {
+            "quietMs": stable_for_ms,
+            "maxMs": max(timeout, stable_for_ms),
+            "childOnly": structural_only,
+        })
     except Exception:
         pass
 
 
 def smart_wait_after_goto(page: Page, timeout: float = 30000) -> None:
-    """Ожидание после page.goto: domcontentloaded, load, networkidle, пауза."""
+    """
+    Ожидание после page.goto: domcontentloaded, load, networkidle, затихание DOM.
+    Уже достигнутые load-состояния Playwright проверяет на стороне клиента, без
+    запроса в браузер; вместо фиксированной паузы — ожидание тишины в DOM.
+    """
     try:
         page.wait_for_load_state("domcontentloaded", timeout=timeout)
     except Exception:
@@ -87,4 +125,6 @@ def smart_wait_after_goto(page: Page, timeout: float = 30000) -> None:
         page.wait_for_load_state("networkidle", timeout=5000)
     except Exception:
         pass
-    time.sleep(0.5)
+    # Не дольше прежней фиксированной паузы (0.5с): анимации и таймеры, пишущие
+    # style/текст каждый кадр, не считаем — только структурные изменения
+    wait_for_dom_stable(page, stable_for_ms=150, timeout=500, structural_only=True)